@@ -0,0 +1,56 @@
+import struct
+
+from cryptography.hazmat.backends.openssl import backend
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.ciphers import Cipher, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
+
+# Key derivation and encryption helpers for the SPAKE2 session, shared by the backend routes
+
+# Binary upload frame: flags, progress, iv, tag, filename length, then filename and ciphertext
+# Only the first frame of a stream needs the filename; later frames can send a zero length
+# The uploader in SPAKE_protocal.py builds its frames from these same definitions
+CHUNK_HEADER = struct.Struct("!BB12s16sI")
+CHUNK_FIRST = 0x01  # iv field starts a new GCM stream
+CHUNK_FINAL = 0x02  # tag field closes the stream
+
+# HKDF salt bound to the handshake: SHA-256 over both SPAKE2 messages, sorted so either side gets the same value
+def transcript_salt(msg_a, msg_b):
+    digest = hashes.Hash(hashes.SHA256())
+    for msg in sorted((msg_a, msg_b)):
+        digest.update(msg)
+    return digest.finalize()
+
+# HKDF extract: one pseudorandom key per session, every subkey is expanded from it
+def hkdf_extract(session_secret_key, salt):
+    h = hmac.HMAC(salt, hashes.SHA256())
+    h.update(session_secret_key)
+    return h.finalize()
+
+# HKDF expand: derive the subkey for one purpose (info label) from the session PRK
+def hkdf_expand_label(prk, info, length=32):
+    return HKDFExpand(
+        algorithm=hashes.SHA256(),
+        length=length,
+        info=info.encode()
+    ).derive(prk)
+
+# Check for AES instructions (x86 "flags" / ARM "Features" in /proc/cpuinfo)
+def cpu_has_aes():
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpuinfo = f.read()
+    except OSError:
+        return True  # not Linux, assume a CPU with AES support
+    for line in cpuinfo.splitlines():
+        name, _, value = line.partition(":")
+        if name.strip() in ("flags", "Features") and "aes" in value.split():
+            return True
+    return False
+
+OPENSSL_VERSION = backend.openssl_version_text()
+
+# Streaming AES-GCM decryptor: one IV and one tag for a whole upload instead of per chunk
+def new_decryptor(cipher_algo, iv):
+    cipher = Cipher(cipher_algo, modes.GCM(iv))
+    return cipher.decryptor()
@@ -1,25 +1,60 @@
 import asyncio
-import base64
 import logging
 import os
+import time
 import uuid
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass, field
+from typing import IO, Optional
 
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import algorithms
 from fastapi import FastAPI, WebSocket, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import Response, HTMLResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
+import orjson
 from spake2 import SPAKE2_Symmetric
+from starlette.background import BackgroundTask
 from starlette.websockets import WebSocketState
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+from crypto_utils import (
+    CHUNK_FINAL, CHUNK_FIRST, CHUNK_HEADER, OPENSSL_VERSION,
+    cpu_has_aes, hkdf_expand_label, hkdf_extract, new_decryptor, transcript_salt,
+)
+
+# SIMD-accelerated base64 when available, with the same calls on top of the stdlib module otherwise
+try:
+    from pybase64 import b64encode_as_string
+except ImportError:
+    from base64 import b64encode
+
+    def b64encode_as_string(s):
+        return b64encode(s).decode()
+
+# Configure logging; per-chunk and per-frame logs are DEBUG, so the default INFO keeps hot paths quiet
+logging.basicConfig(level=os.environ.get("FILETT_LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
+# Crypto self-check: file streams are AES-GCM, which runs several times slower without AES instructions
+aes_instructions = cpu_has_aes()
+logger.info(f"{OPENSSL_VERSION}, CPU AES instructions: {'yes' if aes_instructions else 'no'}")
+if not aes_instructions:
+    logger.warning("No AES instructions reported by the CPU; AES-GCM file transfers will use OpenSSL's slower software path")
+
+# Run the stale task sweep for as long as the app is up
+@asynccontextmanager
+async def lifespan(app):
+    cleanup_task = asyncio.create_task(cleanup_stale_tasks())
+    try:
+        yield
+    finally:
+        cleanup_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await cleanup_task
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"],
@@ -29,125 +64,300 @@ app.add_middleware(
     expose_headers=["X-Task-Id"],
 )
 
-UPLOAD_DIR = "uploads"
-STATIC_DIR = "static"
+UPLOAD_DIR = os.path.abspath("uploads")  # resolved once at startup
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, ".partial")  # WebSocket uploads land here until their tag checks out
+STATIC_DIR = os.path.abspath("static")
+UPLOAD_CHUNK_SIZE = 128 * 1024  # big enough for OpenSSL's bulk paths, small enough to react to a cancel quickly
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024  # batch chunk writes into fewer write syscalls
+TASK_TTL = 10 * 60  # seconds a task with no sockets and no progress is kept before it is swept
+CLEANUP_INTERVAL = 60
+CHUNK_QUEUE_SIZE = 16  # upload frames received ahead of the writer before the socket stops reading
+PROGRESS_INTERVAL = 0.05  # at most 20 progress frames a second per socket; the final state is never held back
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(PARTIAL_DIR, exist_ok=True)
 os.makedirs(STATIC_DIR, exist_ok=True)
 
 # Mount static files directory
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
-# Store progress and WebSocket clients
-progress_tracker = defaultdict(lambda: {"progress": 0, "message": "Pending", "completed": False, "canceled": False})
-websocket_clients = defaultdict(list)
-cancel_events = defaultdict(asyncio.Event)
-session_keys = {}  # Store SPAKE2-derived keys per task_id
+# Everything the server tracks for one task: the progress shown to clients and its sockets
+@dataclass
+class TaskState:
+    task_id: str
+    progress: int = 0
+    message: str = "Pending"
+    completed: bool = False
+    canceled: bool = False
+    ws_clients: list = field(default_factory=list)
+    progress_events: set = field(default_factory=set)  # Per-connection events set whenever progress changes
+    cancel_event: asyncio.Event = field(default_factory=asyncio.Event)
+    updated_at: float = field(default_factory=time.monotonic)  # last progress change, for the stale task sweep
+    active_transfers: int = 0  # HTTP uploads/downloads still using this task; the sweep leaves it alone until they end
+
+    # Progress fields as sent to the client
+    def progress_data(self):
+        return {"progress": self.progress, "message": self.message, "completed": self.completed, "canceled": self.canceled}
+
+# One progress socket's SPAKE2/HKDF session and the file stream it is currently sending
+# Kept per connection, so another socket on the same task can neither end this upload nor replace its key
+@dataclass
+class UploadStream:
+    cipher_algo: Optional[algorithms.AES] = None
+    decryptor: object = None
+    fp: Optional[IO[bytes]] = None
+    part_path: Optional[str] = None  # where the stream is written until it is authenticated
+    final_path: Optional[str] = None
+    in_flight: Optional[asyncio.Future] = None  # final chunk still being verified and moved into place
+
+# Store task state and WebSocket clients
+# This state lives in one process: the progress socket, upload and download of a task must reach the same worker
+tasks = {}  # task_id -> TaskState
 client_id_connections = defaultdict(list) # Store client_id to WebSocket connections
-
-# SPAKE2 stuff below
-def gen_hkdf(session_secret_key, info, length=32):
-    salt = os.urandom(16)
-    key = HKDF(
-        algorithm=hashes.SHA256(),
-        length=length,
-        salt=salt,
-        info=info.encode()
-    ).derive(session_secret_key)
-    return salt, key
-
-# Encrypt data using AES-GCM
-def encrypt_data(data, key):
-    iv = os.urandom(12)
-    cipher = Cipher(algorithms.AES(key), modes.GCM(iv))
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(data) + encryptor.finalize()
-    return iv, ciphertext, encryptor.tag
-
-# Decrypt data using AES-GCM
-def decrypt_data(iv, ciphertext, tag, session_key):
-    cipher = Cipher(algorithms.AES(session_key), modes.GCM(iv, tag))
-    decryptor = cipher.decryptor()
-    return decryptor.update(ciphertext) + decryptor.finalize()
+crypto_executor = ThreadPoolExecutor(max_workers=os.cpu_count()) # OpenSSL releases the GIL, so chunk crypto runs off the event loop
+
+PING_PAYLOAD = orjson.dumps({"action": "ping"}).decode()  # keepalive for idle notification sockets, encoded once
+
+# Look up a task's state, creating it on first use; only called where a task starts (upload or progress socket)
+def get_task(task_id):
+    task = tasks.get(task_id)
+    if task is None:
+        task = tasks[task_id] = TaskState(task_id)
+    return task
+
+# Update a task's progress and wake its progress sockets, but only if something actually changed
+def update_progress(task, **fields):
+    changed = False
+    for name, value in fields.items():
+        if getattr(task, name) != value:
+            setattr(task, name, value)
+            changed = True
+    if changed:
+        task.updated_at = time.monotonic()
+        for event in task.progress_events:
+            event.set()
+
+# Drop tasks nobody is connected to or transferring with once they have gone TASK_TTL without progress
+async def cleanup_stale_tasks():
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        now = time.monotonic()
+        for task_id, task in list(tasks.items()):
+            in_use = task.ws_clients or task.active_transfers
+            if not in_use and now - task.updated_at > TASK_TTL:
+                del tasks[task_id]
+                logger.info(f"Removed stale task: {task_id}")
+
+# Send a JSON text frame encoded with orjson instead of send_json's stdlib encoder
+async def send_json_fast(websocket, obj):
+    await websocket.send_text(orjson.dumps(obj).decode())
+
+# Send server-side progress updates to the client whenever they change
+async def send_progress(websocket, task, progress_event):
+    loop = asyncio.get_running_loop()
+    last_sent = 0.0
+    while True:
+        await progress_event.wait()
+        # Changes that arrive while we hold off are coalesced into the next frame
+        delay = last_sent + PROGRESS_INTERVAL - loop.time()
+        if delay > 0 and not (task.completed or task.canceled):
+            await asyncio.sleep(delay)
+        progress_event.clear()
+        progress_data = task.progress_data()
+        logger.debug("Sending progress for %s: %s", task.task_id, progress_data)
+        await send_json_fast(websocket, progress_data)
+        last_sent = loop.time()
+        if task.completed or task.canceled:
+            logger.info(f"Progress complete or canceled for task: {task.task_id}, closing WebSocket")
+            return
+
+# Receive cancellation requests and file chunks from the client until it disconnects
+# Chunks are queued for write_chunks; a full queue holds off reading more frames until the writer catches up
+async def receive_messages(websocket, task, chunk_queue):
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            await chunk_queue.join()  # finish writing what was already received
+            return
+        if message.get("bytes") is not None:
+            await chunk_queue.put(message["bytes"])
+        else:
+            handle_control_message(task, orjson.loads(message["text"]))
+
+# Decrypt and write queued chunks in order while the receiver keeps reading the socket
+async def write_chunks(task, stream, chunk_queue):
+    while True:
+        raw = await chunk_queue.get()
+        try:
+            await handle_upload_chunk(task, stream, raw)
+        finally:
+            chunk_queue.task_done()
+
+# Handle an encrypted file chunk sent as a binary frame
+async def handle_upload_chunk(task, stream, raw):
+    flags, chunk_progress, iv, tag, name_len = CHUNK_HEADER.unpack_from(raw)
+    offset = CHUNK_HEADER.size
+    ciphertext = memoryview(raw)[offset + name_len:]  # view into the frame, no copy of the ciphertext
+    loop = asyncio.get_running_loop()
+    if flags & CHUNK_FIRST:
+        filename = raw[offset:offset + name_len].decode()
+        # A stream that never reached its final chunk is dropped rather than left half-written
+        await discard_upload(task, stream)
+        # A new stream starts a new file; keep it open until the final chunk instead of reopening per chunk
+        # It is written under a temporary name and only shows up in uploads/ once the tag has been verified
+        stream.decryptor = new_decryptor(stream.cipher_algo, iv)
+        stream.part_path = os.path.join(PARTIAL_DIR, f"{uuid.uuid4().hex}.part")
+        stream.final_path = os.path.join(UPLOAD_DIR, filename)
+        stream.fp = await loop.run_in_executor(None, open, stream.part_path, "wb", WRITE_BUFFER_SIZE)
+        # The message is the same for every chunk of a stream, so format it once here
+        update_progress(task, message=f"Received chunk for {filename}")
+    decryptor = stream.decryptor
+    if decryptor is None:
+        raise ValueError("upload chunk received before the stream IV")
+    fp = stream.fp
+    if flags & CHUNK_FINAL:
+        part_path, final_path = stream.part_path, stream.final_path
+        stream.decryptor = stream.fp = stream.part_path = stream.final_path = None
+        # Shielded so a cancel that stops the writer still leaves the commit for the socket's finally to wait on
+        stream.in_flight = loop.run_in_executor(
+            crypto_executor, decrypt_and_commit, decryptor, fp, ciphertext, tag, part_path, final_path, task.cancel_event
+        )
+        published = await asyncio.shield(stream.in_flight)
+        stream.in_flight = None
+        if published is None:
+            return  # canceled while the tag was being checked, the file is already gone
+    else:
+        # Decrypt and write in the same worker so the plaintext never hops back through the event loop
+        await loop.run_in_executor(crypto_executor, decrypt_and_write, decryptor, fp, ciphertext)
+    update_progress(task, progress=chunk_progress)
+    logger.debug("Received chunk for %s, progress: %d%%", task.task_id, chunk_progress)
+
+# Decrypt one chunk into the stream's temporary file
+def decrypt_and_write(decryptor, fp, ciphertext):
+    fp.write(decryptor.update(ciphertext))
+
+# Decrypt the final chunk and verify the tag; only an authenticated file is moved to its real name
+# Returns the published path, or None if the task was canceled before the move
+def decrypt_and_commit(decryptor, fp, ciphertext, tag, part_path, final_path, cancel_event):
+    try:
+        fp.write(decryptor.update(ciphertext))
+        decryptor.finalize_with_tag(tag)  # GCM emits no trailing plaintext; this only checks the tag
+        sync_and_close(fp)
+        if cancel_event.is_set():
+            os.remove(part_path)
+            return None
+        os.replace(part_path, final_path)
+        return final_path
+    except BaseException:
+        remove_part(fp, part_path)
+        raise
+
+# Close and delete a temporary upload file
+def remove_part(fp, part_path):
+    fp.close()
+    with suppress(FileNotFoundError):
+        os.remove(part_path)
+
+# Drop a connection's unfinished upload stream (disconnect, cancel or a new stream before the final chunk)
+# Closing flushes up to WRITE_BUFFER_SIZE, so the close and unlink run in the executor like the open does
+async def discard_upload(task, stream):
+    if stream.fp is not None:
+        fp, part_path = stream.fp, stream.part_path
+        stream.fp = None
+        # Shielded so the handler being cancelled on disconnect can't stop the job before the file is removed
+        await asyncio.shield(asyncio.get_running_loop().run_in_executor(None, remove_part, fp, part_path))
+        logger.info(f"Discarded unfinished upload of {stream.final_path} for task: {task.task_id}")
+    stream.decryptor = stream.fp = stream.part_path = stream.final_path = None
+
+# Flush and fsync a finished file once, then close it
+def sync_and_close(fp):
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+
+# Handle a JSON control message sent as a text frame
+def handle_control_message(task, message):
+    if message.get("action") == "cancel":
+        task.cancel_event.set()
+        update_progress(task, canceled=True, message="Upload canceled by client")
+        logger.info(f"Cancellation request for task:{task.task_id} received via WebSocket")
 
 # WebSocket endpoint for progress updates
 @app.websocket("/ws/progress/{task_id}")
 async def websocket_progress(websocket: WebSocket, task_id: str, client_id: str = None):
     await websocket.accept()
-    websocket_clients[task_id].append(websocket)
-    logger.info(f"WebSocket connected for task_id: {task_id}, client_id: {client_id or 'unknown'}, clients: {len(websocket_clients[task_id])}, ip: {websocket.client.host}:{websocket.client.port}")
-
-    # Perform SPAKE2 key exchange using Symmetric mode
-    # Use task_id as the shared identifier to ensure both sides use the same password
-    password = (task_id + client_id).encode() if client_id else task_id.encode()
-    spake2 = SPAKE2_Symmetric(password)
-    msg_out = spake2.start()
-    await websocket.send_json({"spake2_msg": base64.b64encode(msg_out).decode()})
+    task = get_task(task_id)
+    task.ws_clients.append(websocket)
+    progress_event = asyncio.Event()
+    progress_event.set()  # send the current state once on connect
+    task.progress_events.add(progress_event)
+    stream = UploadStream()
+    logger.info(f"WebSocket connected for task_id: {task_id}, client_id: {client_id or 'unknown'}, clients: {len(task.ws_clients)}, ip: {websocket.client.host}:{websocket.client.port}")
 
     try:
+        # Perform SPAKE2 key exchange using Symmetric mode
+        # Use task_id as the shared identifier to ensure both sides use the same password
+        # The group operations in start()/finish() run in the crypto pool so they don't block other sockets
+        # The whole handshake is inside the try so a client dropping mid-handshake still gets cleaned up
+        loop = asyncio.get_running_loop()
+        password = (task_id + client_id).encode() if client_id else task_id.encode()
+        spake2 = SPAKE2_Symmetric(password)
+        msg_out = await loop.run_in_executor(crypto_executor, spake2.start)
+        # The SPAKE2 messages are raw group elements, so they go as binary frames with no base64 or JSON wrapping
+        await websocket.send_bytes(msg_out)
+
         # Receive client's SPAKE2 message
-        msg_in_data = await websocket.receive_json()
-        msg_in = base64.b64decode(msg_in_data.get("spake2_msg", ""))
-        session_key = spake2.finish(msg_in)
-        salt, derived_key = gen_hkdf(session_key, "file_encryption")
-        session_keys[task_id] = derived_key
-        await websocket.send_json({
-            "hkdf_salt": base64.b64encode(salt).decode(),
+        msg_in = await websocket.receive_bytes()
+        session_key = await loop.run_in_executor(crypto_executor, spake2.finish, msg_in)
+        # Both sides can compute the salt from the handshake; it is still sent for clients that expect it
+        salt = transcript_salt(msg_out, msg_in)
+        prk = hkdf_extract(session_key, salt)
+        # Only the keyed cipher object is kept, built once per session; the raw key isn't stored
+        derived_key = hkdf_expand_label(prk, "file_encryption")
+        stream.cipher_algo = algorithms.AES(derived_key)
+        await send_json_fast(websocket, {
+            "hkdf_salt": b64encode_as_string(salt),
             "hkdf_info": "file_encryption"
         })
         logger.info(f"SPAKE2 key exchange completed for task_id: {task_id}")
 
-        while True:
-            # send server-side progress updates to the client
-            progress_data = progress_tracker[task_id]
-            logger.info(f"Sending progress for {task_id}: {progress_data}")
-            await websocket.send_json(progress_data)
-
-            #check for cancellation requests from the client
-            try:
-                message = await asyncio.wait_for(websocket.receive_json(), timeout=0.5)
-                if message.get("action") == "cancel":
-                    progress_tracker[task_id]["canceled"] = True
-
-                    if task_id not in cancel_events:
-                        cancel_events[task_id] = asyncio.Event()
-
-                    cancel_events[task_id].set()
-                    progress_tracker[task_id]["message"] = "Upload canceled by client"
-                    logger.info(f"Cancellation request for task:{task_id} received via WebSocket")
-                elif message.get("action") == "upload_chunk":
-                    # Handle encrypted file chunk
-                    iv = base64.b64decode(message["iv"])
-                    ciphertext = base64.b64decode(message["ciphertext"])
-                    tag = base64.b64decode(message["tag"])
-                    chunk = decrypt_data(iv, ciphertext, tag, session_keys[task_id])
-                    filepath = os.path.join(UPLOAD_DIR, message["filename"])
-                    with open(filepath, "ab") as f:
-                        f.write(chunk)
-                    progress_tracker[task_id]["progress"] = message.get("progress", 0)
-                    progress_tracker[task_id]["message"] = f"Received chunk for {message['filename']}"
-                    logger.info(f"Received chunk for {task_id}, progress: {progress_tracker[task_id]['progress']}%")
-            except asyncio.TimeoutError:
-                pass # no message received, continue to send progress updates
-            if progress_data["completed"] or progress_data["canceled"]:
-                logger.info(f"Progress complete or canceled for task: {task_id}, closing WebSocket")
-                break
-
+        # Send progress, receive client messages and write chunks concurrently; whichever finishes first closes the socket
+        chunk_queue = asyncio.Queue(maxsize=CHUNK_QUEUE_SIZE)
+        sender_task = asyncio.create_task(send_progress(websocket, task, progress_event))
+        receiver_task = asyncio.create_task(receive_messages(websocket, task, chunk_queue))
+        writer_task = asyncio.create_task(write_chunks(task, stream, chunk_queue))
+        done, pending = await asyncio.wait({sender_task, receiver_task, writer_task}, return_when=asyncio.FIRST_COMPLETED)
+        for pending_task in pending:
+            pending_task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for done_task in done:
+            done_task.result()  # re-raise any error from the finished side
+
+    except InvalidTag:
+        # The file has already been deleted; tell the client explicitly instead of just closing the socket
+        logger.error(f"Upload for {task_id} failed authentication (InvalidTag), file discarded")
+        update_progress(task, message="Upload failed authentication, file discarded")
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await send_json_fast(websocket, {**task.progress_data(), "error": "auth_failed"})
     except Exception as e:
-        logger.error(f"WebSocket error for {task_id}: {str(e)}")
-        progress_tracker[task_id]["message"] = f"WebSocket error: {str(e)}"
+        logger.error(f"WebSocket error for {task_id}: {type(e).__name__}: {e}")
+        update_progress(task, message=f"WebSocket error: {type(e).__name__}")
     finally:
-        websocket_clients[task_id].remove(websocket)
+        # A final chunk may still be committing in the pool; wait for it so a cancel can't leave a published file behind
+        if stream.in_flight is not None:
+            with suppress(Exception):
+                published = await stream.in_flight
+                if published is not None and task.cancel_event.is_set():
+                    await loop.run_in_executor(None, os.remove, published)
+                    logger.info(f"Removed {published} finished after task {task_id} was canceled")
+        # Delete a file left by this socket's stream if it never reached its final chunk (disconnect or cancel)
+        await discard_upload(task, stream)
+        task.ws_clients.remove(websocket)
+        task.progress_events.discard(progress_event)
         if websocket.application_state == WebSocketState.CONNECTED:
             await websocket.close()
-        logger.info(f"WebSocket closed for {task_id}, client_id:{client_id or 'unknown'}, clients: {len(websocket_clients[task_id])}")
-        if not websocket_clients[task_id]:
-            del websocket_clients[task_id]
-            if progress_tracker[task_id]["canceled"] or progress_tracker[task_id]["completed"]:
-                del progress_tracker[task_id]
-                if task_id in cancel_events:
-                    del cancel_events[task_id]
-                if task_id in session_keys:
-                    del session_keys[task_id]
+        logger.info(f"WebSocket closed for {task_id}, client_id:{client_id or 'unknown'}, clients: {len(task.ws_clients)}")
+        if not task.ws_clients and (task.canceled or task.completed):
+            tasks.pop(task_id, None)
 
 # WebSocket endpoint for notifications
 @app.websocket("/ws/notifications")
@@ -164,79 +374,132 @@ async def websocket_notifications(websocket: WebSocket, client_id: str = None):
         while True:
             # Keep connection alive and handle any incoming messages
             try:
-                message = await asyncio.wait_for(websocket.receive_json(), timeout=30)
+                message = orjson.loads(await asyncio.wait_for(websocket.receive_text(), timeout=30))
                 logger.info(f"Received message from client {client_id}: {message}")
                 # Handle any client messages here
             except asyncio.TimeoutError:
                 # Send a ping to keep the connection alive
-                await websocket.send_json({"action": "ping"})
+                await websocket.send_text(PING_PAYLOAD)
     except Exception as e:
         logger.error(f"WebSocket error for client {client_id}: {str(e)}")
     finally:
-        if client_id in client_id_connections:
-            if websocket in client_id_connections[client_id]:
-                client_id_connections[client_id].remove(websocket)
+        # Drop the client_id once its last socket is gone, so the keys are exactly the connected clients
+        connections = client_id_connections.get(client_id)
+        if connections is not None:
+            if websocket in connections:
+                connections.remove(websocket)
+            if not connections:
+                del client_id_connections[client_id]
         if websocket.application_state == WebSocketState.CONNECTED:
             await websocket.close()
         logger.info(f"Notifications WebSocket closed for client_id: {client_id}")
 
+# Notify all notification clients at once so one slow client doesn't stall the others
+async def broadcast_upload_complete(filename, task_id):
+    # Serialize once for every recipient instead of once per send_json call
+    payload = orjson.dumps({"action": "upload_complete", "filename": filename, "task_id": task_id}).decode()
+
+    async def safe_send(client_id, ws):
+        try:
+            await asyncio.wait_for(ws.send_text(payload), timeout=5.0)
+        except Exception as e:
+            logger.error(f"Failed to notify client {client_id}: {str(e)}")
+            return client_id, ws
+
+    targets = [(client_id, ws) for client_id, connections in client_id_connections.items() for ws in connections]
+    results = await asyncio.gather(*(safe_send(client_id, ws) for client_id, ws in targets))
+
+    # Prune sockets that failed or timed out
+    for failed in filter(None, results):
+        client_id, ws = failed
+        if ws in client_id_connections.get(client_id, []):
+            client_id_connections[client_id].remove(ws)
+        if client_id in client_id_connections and not client_id_connections[client_id]:
+            del client_id_connections[client_id]
+
 # Upload endpoint
 @app.post("/upload/")
 async def upload_file(file: UploadFile = File(...), task_id: str = Form(None)):
     # Generate a task_id if not provided
     if not task_id:
         task_id = f"task-{uuid.uuid4()}"
+    task = get_task(task_id)
+    # Bind what the copy loop reads on every chunk to locals once
+    cancel_event = task.cancel_event
+    filename = file.filename
+    saving_message = f"Saving {filename}"
+    task.active_transfers += 1
 
     try:
         # Create file path
-        file_path = os.path.join(UPLOAD_DIR, file.filename)
+        file_path = os.path.join(UPLOAD_DIR, filename)
 
         # Save the file
-        with open(file_path, "wb") as f:
-            # Read and write the file in chunks
-            chunk_size = 64 * 1024  # 64KB chunks
+        loop = asyncio.get_running_loop()
+        with open(file_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            # Read and write the file in chunks through one reused buffer instead of a new bytes object per chunk
+            buffer = bytearray(UPLOAD_CHUNK_SIZE)
+            view = memoryview(buffer)
+            total_size = file.size or 0
+            bytes_written = 0
+            last_percent = -1
+
+            def copy_chunk():
+                n = file.file.readinto(buffer)
+                if n:
+                    f.write(view[:n])
+                return n
+
             while True:
-                chunk = await file.read(chunk_size)
-                if not chunk:
+                # Stop at the next chunk boundary once the task is canceled
+                if cancel_event.is_set():
                     break
-                f.write(chunk)
+                # Read and write in a worker thread so a slow disk doesn't block the event loop
+                n = await loop.run_in_executor(None, copy_chunk)
+                if not n:
+                    break
+                bytes_written += n
+
+                # Only report whole-percent steps, not every chunk
+                if total_size:
+                    percent = bytes_written * 100 // total_size
+                    if percent != last_percent:
+                        last_percent = percent
+                        update_progress(task, progress=percent, message=saving_message)
+            # Flush and sync once at the end rather than per chunk
+            if not cancel_event.is_set():
+                await loop.run_in_executor(None, f.flush)
+                await loop.run_in_executor(None, os.fsync, f.fileno())
+
+        # Drop the partial file of a canceled upload
+        if cancel_event.is_set():
+            os.remove(file_path)
+            logger.info(f"Upload of {filename} canceled for task: {task_id}")
+            return {"message": "Upload canceled", "task_id": task_id}
 
         # Mark the upload as completed
-        progress_tracker[task_id]["progress"] = 100
-        progress_tracker[task_id]["completed"] = True
-        progress_tracker[task_id]["message"] = f"Upload of {file.filename} completed"
+        update_progress(task, progress=100, completed=True, message=f"Upload of {filename} completed")
 
         # Notify any connected clients about the completed upload
-        for client_id, connections in client_id_connections.items():
-            for ws in connections:
-                try:
-                    await ws.send_json({
-                        "action": "upload_complete",
-                        "filename": file.filename,
-                        "task_id": task_id
-                    })
-                except Exception as e:
-                    logger.error(f"Failed to notify client {client_id}: {str(e)}")
+        await broadcast_upload_complete(filename, task_id)
 
         return {"message": "File uploaded successfully", "task_id": task_id}
 
     except Exception as e:
         logger.error(f"Upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+    finally:
+        task.active_transfers -= 1
 
 # Cancel endpoint
 @app.post("/cancel/{task_id}")
 async def cancel_upload(task_id: str):
-    if task_id not in progress_tracker:
+    task = tasks.get(task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    progress_tracker[task_id]["canceled"] = True
-    progress_tracker[task_id]["message"] = "Upload canceled by client"
-
-    if task_id not in cancel_events:
-        cancel_events[task_id] = asyncio.Event()
-
-    cancel_events[task_id].set()
+    update_progress(task, canceled=True, message="Upload canceled by client")
+    task.cancel_event.set()
 
     return {"message": f"Upload for task {task_id} canceled"}
 
@@ -324,34 +587,49 @@ async def favicon():
 async def download_file(filename: str, task_id: str = None):
     file_path = os.path.join(UPLOAD_DIR, filename)
 
-    if not os.path.exists(file_path):
+    if not os.path.isfile(file_path):
         raise HTTPException(status_code=404, detail=f"File {filename} not found")
 
-    # If task_id is provided, we can use it to track download progress
-    if task_id:
-        progress_tracker[task_id]["message"] = f"Downloading {filename}"
-        progress_tracker[task_id]["progress"] = 0
-
-    try:
-        # Read the file in chunks
-        with open(file_path, "rb") as f:
-            content = f.read()
-
-        # If task_id is provided, mark the download as completed
-        if task_id:
-            progress_tracker[task_id]["progress"] = 100
-            progress_tracker[task_id]["completed"] = True
-            progress_tracker[task_id]["message"] = f"Download of {filename} completed"
-
-        # Return the file as a response
-        return Response(
-            content=content,
-            media_type="application/octet-stream",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
-
-    except Exception as e:
-        logger.error(f"Download error: {str(e)}")
-        if task_id:
-            progress_tracker[task_id]["message"] = f"Download failed: {str(e)}"
-        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+    # If task_id belongs to a known task, we can use it to track download progress
+    task = tasks.get(task_id) if task_id else None
+    if task:
+        update_progress(task, progress=0, message=f"Downloading {filename}")
+
+    headers = {"X-Task-Id": task_id} if task_id else None
+    background = BackgroundTask(mark_download_complete, task, filename) if task else None
+
+    # Stream the file from disk (sendfile where the server supports it) instead of reading it into memory
+    return TaskFileResponse(
+        file_path,
+        task=task,
+        media_type="application/octet-stream",
+        filename=filename,
+        headers=headers,
+        background=background,
+    )
+
+# FileResponse that keeps its task marked in use until the body is sent or the client goes away
+class TaskFileResponse(FileResponse):
+    def __init__(self, *args, task=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.task = task
+
+    async def __call__(self, scope, receive, send):
+        if self.task is None:
+            return await super().__call__(scope, receive, send)
+        self.task.active_transfers += 1
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.task.active_transfers -= 1
+
+# Mark a tracked download as completed once the response body has been sent
+def mark_download_complete(task, filename):
+    update_progress(task, progress=100, completed=True, message=f"Download of {filename} completed")
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # "auto" selects uvloop and httptools when they are installed (see requirements.txt), else asyncio and h11
+    # Run a single worker; tasks and notification sockets are in-process state that workers can't share
+    uvicorn.run(app, host="localhost", port=8000, loop="auto", http="auto")
@@ -43,6 +43,7 @@ function UploadForm() {
   const connectWebSocket = (taskId: string) => {
     console.log(`[${clientId}] Connecting WebSocket for task_id: ${taskId}`);
     const websocket = new WebSocket(`ws://localhost:8000/ws/progress/${taskId}?client_id=${clientId}`);
+    websocket.binaryType = "arraybuffer"; // SPAKE2 messages arrive as raw bytes
 
     // For SPAKE2 key exchange
     let spake2Initialized = false;
@@ -52,10 +53,11 @@ function UploadForm() {
       console.log(`[${clientId}] WebSocket opened for task_id: ${taskId} at ${new Date().toISOString()}`);
     }
     websocket.onmessage = (event) => {
-      const data = JSON.parse(event.data);
-
-      // Handle SPAKE2 key exchange messages
-      if (data.spake2_msg && !spake2Initialized) {
+      // Handle SPAKE2 key exchange messages (the only binary frames the server sends)
+      if (event.data instanceof ArrayBuffer) {
+        if (spake2Initialized) {
+          return;
+        }
         // Received SPAKE2 message from server, need to respond with our own message
         console.log(`[${clientId}] Received SPAKE2 message from server for ${taskId}`);
 
@@ -64,15 +66,15 @@ function UploadForm() {
 
         // In a real implementation, we would use the SPAKE2_Symmetric library here
         // For now, we'll just echo back the same message to simulate the exchange
-        websocket.send(JSON.stringify({
-          spake2_msg: data.spake2_msg
-        }));
+        websocket.send(event.data);
 
         spake2Initialized = true;
         console.log(`[${clientId}] Sent SPAKE2 response for ${taskId}`);
         return;
       }
 
+      const data = JSON.parse(event.data);
+
       // Handle HKDF salt and info (part of the key exchange)
       if (data.hkdf_salt && data.hkdf_info) {
         console.log(`[${clientId}] Received HKDF parameters for ${taskId}`);
@@ -1,47 +1,82 @@
+import asyncio
+from typing import Protocol
 from fastapi import WebSocket
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import os
 
+# The backend's upload frame layout, imported rather than copied so the two sides can't drift
+from Backend.crypto_utils import CHUNK_FINAL, CHUNK_FIRST, CHUNK_HEADER
+
+class ProgressSocket(Protocol):
+    """Client connection to the backend's /ws/progress/{task_id}, after the SPAKE2 handshake."""
+    async def send_bytes(self, data: bytes) -> None: ...
+
 async def send_encrypted_file(
-    ws: WebSocket,
+    ws: ProgressSocket,
     file_path: str,
-    aesgcm: AESGCM,
-    nonce: bytes,
+    key: bytes,
     chunk_size: int = 64 * 1024
 ):
     """
-    Encrypts and streams the contents of `file_path` over the WebSocket.
-    Each chunk is encrypted with the same nonce (you may rotate per chunk if you like).
+    Encrypts and streams the contents of `file_path` to the backend as a client
+    of /ws/progress/{task_id}, in the binary upload frames that endpoint parses.
+    `ws` is the client side of that socket; only its `send_bytes` is used.
+    The whole file is one AES-GCM stream: the first frame carries the random
+    nonce and the filename, each frame carries the next piece of ciphertext,
+    and the final frame carries the tag for the whole stream.
+    Reading and encrypting run in a worker thread (OpenSSL releases the GIL),
+    so the event loop keeps serving other sockets while a chunk is prepared.
+    `key` is the session's derived "file_encryption" key.
     """
-    # 1) Send filename metadata first
-    await ws.send_json({
-        "type": "file",
-        "filename": os.path.basename(file_path),
-        "nonce": nonce.hex(),
-    })
+    nonce = os.urandom(12)
+    encryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+    filename = os.path.basename(file_path).encode()
+    total_size = os.path.getsize(file_path)
+    sent = 0
 
-    # 2) Open and stream encrypted chunks
     with open(file_path, "rb") as f:
-        while True:
+        def read_and_encrypt():
             plaintext = f.read(chunk_size)
-            if not plaintext:
-                break
-            ciphertext = aesgcm.encrypt(nonce, plaintext, None)
-            await ws.send_bytes(ciphertext)  # whole binary frame :contentReference[oaicite:0]{index=0}
+            return len(plaintext), encryptor.update(plaintext)
 
-    # 3) Signal end-of-file (optional)
-    await ws.send_json({"type": "file_end"})  # so server knows to stop reading
+        # Read one chunk ahead, so the last chunk is known and can carry the tag
+        size, ciphertext = await asyncio.to_thread(read_and_encrypt)
+        flags = CHUNK_FIRST
+        while True:
+            next_size, next_ciphertext = await asyncio.to_thread(read_and_encrypt) if size else (0, b"")
+            iv = nonce if flags & CHUNK_FIRST else bytes(12)
+            name = filename if flags & CHUNK_FIRST else b""
+            tag = bytes(16)
+            if not next_size:
+                encryptor.finalize()
+                tag = encryptor.tag
+                flags |= CHUNK_FINAL
+            sent += size
+            # Clamped so a file that grows while it is read still fits the header's progress byte
+            progress = min(sent * 100 // total_size, 100) if total_size else 100
+            header = CHUNK_HEADER.pack(flags, progress, iv, tag, len(name))
+            await ws.send_bytes(header + name + ciphertext)  # whole binary frame
+            if flags & CHUNK_FINAL:
+                break
+            flags = 0
+            size, ciphertext = next_size, next_ciphertext
 
 async def send_encrypted_message(
     ws: WebSocket,
     message: str,
-    aesgcm: AESGCM,
-    nonce: bytes
+    aesgcm: AESGCM
 ):
+    """
+    Encrypts one message under a fresh random nonce, sent alongside the payload.
+    A nonce must never repeat under the same key, so callers don't supply one.
+    """
+    nonce = os.urandom(12)
     plaintext = message.encode("utf-8")
     ciphertext = aesgcm.encrypt(nonce, plaintext, None)  # AES-GCM AEAD :contentReference[oaicite:1]{index=1}
     # send as hex in a JSON wrapper so server can parse it
     await ws.send_json({
         "type": "message",
+        "nonce": nonce.hex(),
         "payload": ciphertext.hex(),
     })